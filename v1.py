@@ -1,19 +1,68 @@
 from flask import Flask, jsonify, abort, request
+import base64
+import calendar
 import docker
+import functools
+import gzip
+import hashlib
+import math
+import mmap
 import os
+import queue
+import re
+import requests
+import socket
+import sqlite3
+import struct
 import threading
 import time
 import psutil
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 app = Flask(__name__)
 
+# =============================
+# Collector Config
+# =============================
+# Number of containers sampled concurrently. The docker client pools a
+# connection per worker plus a few for ?fresh=1 samples and event-driven
+# inventory refreshes, so nobody has to open a throwaway socket.
+COLLECT_WORKERS = max(1, int(os.getenv("COLLECT_WORKERS", "10")))
+
+# Keep the container inventory up to date from the docker events stream
+# instead of re-listing every cycle. Set USE_EVENTS=0 to always list.
+USE_EVENTS = os.getenv("USE_EVENTS", "1") == "1"
+
+# Where container cpu/memory comes from:
+#   poll   - one stats(stream=False) call per container per cycle
+#   stream - one long-lived stats stream per running container
+#   cgroup - read cpu/memory straight from the cgroup filesystem, falling
+#            back to poll for containers whose cgroup is not readable
+STATS_MODE = os.getenv("STATS_MODE", "poll")
+CGROUP_ROOT = os.getenv("CGROUP_ROOT", "/sys/fs/cgroup")
+
+# Per-container network straight from /proc/<pid>/net, sampled every
+# NET_INTERVAL seconds (0 disables) with NET_HISTORY samples kept each.
+# Point PROC_ROOT at the host's /proc when the agent runs in a container.
+PROC_ROOT = os.getenv("PROC_ROOT", "/proc")
+NET_INTERVAL = float(os.getenv("NET_INTERVAL", "1"))
+NET_HISTORY = int(os.getenv("NET_HISTORY", "300"))
+
 # =============================
 # Docker Client
 # =============================
+# Long-lived streams (events, per-container stats) each hold a connection
+# for as long as they run, so they get their own client and never eat into
+# the collector's pool. urllib3 only opens connections on demand, so a
+# generous pool size costs nothing when fewer streams are open.
 try:
-    docker_client = docker.from_env()
+    docker_client = docker.from_env(max_pool_size=COLLECT_WORKERS + 4)
+    stream_client = docker.from_env(max_pool_size=256)
 except Exception as e:
-    docker_client = None
+    docker_client = stream_client = None
     print("Docker error:", e)
 
 # =============================
@@ -22,17 +71,85 @@ except Exception as e:
 API_KEY = os.getenv("API_KEY", "38f863078f79bdc96e199552ba728afd")
 
 # =============================
-# Cache + Lock
+# Snapshot Cache
 # =============================
+# The collector builds a new snapshot dict every cycle and publishes it by
+# rebinding cached_data, which is atomic. A published snapshot is never
+# mutated, so readers just grab the reference once and need no lock.
 cached_data = {
     "containers": [],
     "system": {},
     "last_update": ""
 }
 
-lock = threading.Lock()
 INTERVAL = 5  # detik
 
+# Bodies at least this large are also kept gzip-compressed (bytes)
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+
+# /api/v1/stream: seconds between keepalive comments, and how many
+# unsent snapshots a slow client may fall behind before it is resynced
+STREAM_KEEPALIVE = 15
+STREAM_QUEUE_SIZE = 8
+
+# How many versions back ?since_version= can answer incrementally; older
+# cursors (or ones from before a restart) get the full listing
+VERSION_HISTORY = 1000
+
+# Listing cursors stay valid for this long after a newer snapshot replaced
+# theirs, however many versions a burst of events publishes meanwhile
+SNAPSHOT_KEEP = 6 * INTERVAL  # detik
+
+# ?fresh=1 results on /api/v1/containers/<id> are reused for this long
+FRESH_TTL = 2  # detik
+
+# Samples kept in memory per container and for the host (one per cycle)
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "3600"))
+
+# Downsampled tiers behind the raw ring: (bucket seconds, buckets kept).
+# Default: 1-minute buckets for a day, 1-hour buckets for 30 days.
+ROLLUP_TIERS = ((60, 1440), (3600, 720))
+
+# Latest snapshot and history rings are kept in memory-mapped files here so
+# a restarted agent can serve the last known state at once (marked stale).
+# Set STATE_DIR= (empty) to keep everything in memory only.
+STATE_DIR = os.getenv(
+    "STATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "state")
+)
+SNAPSHOT_SLOT_SIZE = int(os.getenv("SNAPSHOT_SLOT_SIZE", str(4 * 1024 * 1024)))
+
+# Optional SQLite archive of every container sample for long-term history.
+# Disabled unless ARCHIVE_PATH is set.
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "")
+ARCHIVE_FLUSH = int(os.getenv("ARCHIVE_FLUSH", "10"))              # detik
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))
+ARCHIVE_COMPACT_DAYS = int(os.getenv("ARCHIVE_COMPACT_DAYS", "7"))  # then 1m
+
+# Optional push exporter for hosts that cannot be scraped. Disabled unless
+# PUSH_URL is set. PUSH_MODE is "delta" or "snapshot"; PUSH_BATCH cycles go
+# into one gzip'd POST, and failed POSTs wait in a bounded on-disk spool.
+PUSH_URL = os.getenv("PUSH_URL", "")
+PUSH_MODE = os.getenv("PUSH_MODE", "delta")
+PUSH_BATCH = max(1, int(os.getenv("PUSH_BATCH", "6")))
+PUSH_TIMEOUT = int(os.getenv("PUSH_TIMEOUT", "10"))  # detik
+PUSH_API_KEY = os.getenv("PUSH_API_KEY", "")
+PUSH_SPOOL_DIR = os.getenv(
+    "PUSH_SPOOL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "state", "spool")
+)
+PUSH_SPOOL_MAX = int(os.getenv("PUSH_SPOOL_MAX", "1000"))  # batches
+HOST_LABEL = os.getenv("HOST_LABEL", socket.gethostname())
+
+# Fleet aggregator: comma-separated agent base URLs, optionally labelled
+# as label=url, e.g. "web1=http://10.0.0.5:7000,http://10.0.0.6:7000".
+FLEET_AGENTS = [a.strip() for a in os.getenv("FLEET_AGENTS", "").split(",") if a.strip()]
+FLEET_API_KEY = os.getenv("FLEET_API_KEY", "")
+FLEET_WORKERS = int(os.getenv("FLEET_WORKERS", "32"))
+FLEET_TIMEOUT = int(os.getenv("FLEET_TIMEOUT", "5"))  # detik
+
+# Set to run the next collection cycle right away instead of after INTERVAL
+collect_now = threading.Event()
+
 # =============================
 # Helper: CPU %
 # =============================
@@ -44,7 +161,10 @@ def calculate_cpu_percent(stats):
         system_delta = stats["cpu_stats"]["system_cpu_usage"] - \
                        stats["precpu_stats"]["system_cpu_usage"]
 
-        cpu_count = len(stats["cpu_stats"]["cpu_usage"].get("percpu_usage", []))
+        # percpu_usage is not reported on cgroup v2 hosts
+        cpu_count = stats["cpu_stats"].get("online_cpus") or \
+                    len(stats["cpu_stats"]["cpu_usage"].get("percpu_usage") or []) or \
+                    psutil.cpu_count()
 
         if system_delta > 0:
             return round((cpu_delta / system_delta) * cpu_count * 100, 2)
@@ -52,71 +172,2363 @@ def calculate_cpu_percent(stats):
         pass
     return 0.0
 
+# =============================
+# Container Snapshot Helpers
+# =============================
+# The list endpoint (/containers/json) already carries State, Status, Ports,
+# Image and Labels, so containers are listed sparse. A full inspect is only
+# needed for fields the list payload lacks (RestartCount), and only when the
+# container's state changed since the last inspect. A restart between two
+# cycles keeps the state "running", so the "Up ..." duration is tracked as
+# well: uptime going backwards means the container started again.
+# Image tags move with docker pull/tag, so they are only cached for
+# IMAGE_TAGS_TTL seconds.
+IMAGE_TAGS_TTL = 60
+
+inspect_cache = {}     # container id -> (inspect_key, attrs)
+container_uptime = {}  # container id -> uptime seconds seen last cycle
+image_tags = {}        # image id -> (monotonic time, tags)
+
+UPTIME_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400,
+                "week": 604800, "month": 2592000, "year": 31536000}
+UPTIME = re.compile(r"Up (?:(Less than a second)|About an? (minute|hour)|(\d+) (\w+?)s?\b)")
+
+def container_name(attrs):
+    names = attrs.get("Names") or []
+    if names:
+        return names[0].lstrip("/")
+    return (attrs.get("Name") or "").lstrip("/")
+
+def inspect_key(attrs):
+    # Status looks like "Up 2 hours (healthy)" or "Exited (137) 5 minutes ago";
+    # only the parenthesised part is meaningful, the durations tick forever.
+    flags = re.findall(r"\(([^)]*)\)", attrs.get("Status", ""))
+    return (attrs.get("State"), attrs.get("ImageID"), tuple(flags))
+
+def parse_uptime(status):
+    # "Up Less than a second", "Up About an hour", "Up 3 days (healthy)"
+    m = UPTIME.match(status or "")
+    if not m:
+        return None
+    if m.group(1):
+        return 0
+    if m.group(2):
+        return UPTIME_UNITS[m.group(2)]
+    return int(m.group(3)) * UPTIME_UNITS.get(m.group(4), 1)
+
+def inspect_container(c):
+    key = inspect_key(c.attrs)
+    cached = inspect_cache.get(c.id)
+    uptime = parse_uptime(c.attrs.get("Status"))
+    last_uptime = container_uptime.get(c.id)
+    container_uptime[c.id] = uptime
+    restarted = uptime is not None and last_uptime is not None and uptime < last_uptime
+    if cached and cached[0] == key and not restarted:
+        return cached[1]
+    attrs = docker_client.api.inspect_container(c.id)
+    inspect_cache[c.id] = (key, attrs)
+    return attrs
+
+def get_image_tags(image_id):
+    if not image_id:
+        return []
+    cached = image_tags.get(image_id)
+    if cached is None or time.monotonic() - cached[0] >= IMAGE_TAGS_TTL:
+        tags = docker_client.images.get(image_id).tags or []
+        image_tags[image_id] = cached = (time.monotonic(), tags)
+    return cached[1]
+
+def format_ports(port_list):
+    # Same shape as NetworkSettings.Ports: {"80/tcp": [{"HostIp", "HostPort"}]}
+    ports = {}
+    for p in port_list or []:
+        key = "%s/%s" % (p.get("PrivatePort"), p.get("Type", "tcp"))
+        if p.get("PublicPort") is None:
+            ports.setdefault(key, None)
+            continue
+        if ports.get(key) is None:
+            ports[key] = []
+        ports[key].append({
+            "HostIp": p.get("IP", ""),
+            "HostPort": str(p["PublicPort"])
+        })
+    return ports
+
+def prune_caches(containers):
+    live_ids = {c.id for c in containers}
+    live_images = {c.attrs.get("ImageID") for c in containers}
+    for cid in list(inspect_cache):
+        if cid not in live_ids:
+            inspect_cache.pop(cid, None)
+    for cid in list(container_uptime):
+        if cid not in live_ids:
+            container_uptime.pop(cid, None)
+    for key in list(cgroup_dirs):
+        if key[0] not in live_ids:
+            cgroup_dirs.pop(key, None)
+    for cid in list(cgroup_prev):
+        if cid not in live_ids:
+            cgroup_prev.pop(cid, None)
+    for cid in list(rate_prev):
+        if cid not in live_ids:
+            rate_prev.pop(cid, None)
+    with proc_lock:
+        for cid in set(proc_handles) | set(proc_locks):
+            if cid not in live_ids:
+                proc_handles.pop(cid, None)
+                proc_sampled.pop(cid, None)
+                proc_locks.pop(cid, None)
+    for image_id in list(image_tags):
+        if image_id not in live_images:
+            image_tags.pop(image_id, None)
+
+# =============================
+# Event Inventory
+# =============================
+# Container id -> sparse Container, seeded by one full listing and then
+# patched from the events stream. Only trusted while events_connected is set;
+# otherwise update_data falls back to listing.
+inventory = {}
+inventory_lock = threading.Lock()
+events_connected = threading.Event()
+
+INVENTORY_ACTIONS = {
+    "create", "start", "restart", "die", "stop", "kill", "oom",
+    "pause", "unpause", "rename", "update", "destroy"
+}
+
+def event_cursor(event):
+    # "seconds.nanoseconds" is what the daemon accepts for since=
+    if event.get("timeNano"):
+        return "%d.%09d" % divmod(event["timeNano"], 10 ** 9)
+    return event.get("time")
+
+def resync_inventory():
+    containers = docker_client.containers.list(all=True, sparse=True)
+    with inventory_lock:
+        inventory.clear()
+        for c in containers:
+            inventory[c.id] = c
+
+def refresh_inventory(cid):
+    found = docker_client.containers.list(
+        all=True, sparse=True, filters={"id": cid}
+    )
+    with inventory_lock:
+        inventory.pop(cid, None)
+        for c in found:
+            inventory[c.id] = c
+    # RestartCount and friends may have moved, force a fresh inspect
+    inspect_cache.pop(cid, None)
+
+def handle_event(event):
+    action = event.get("Action") or event.get("status") or ""
+    cid = event.get("id") or event.get("Actor", {}).get("ID")
+    if not cid:
+        return
+    action = action.split(":")[0]
+    if action not in INVENTORY_ACTIONS and action != "health_status":
+        return
+
+    if action == "destroy":
+        with inventory_lock:
+            inventory.pop(cid, None)
+        inspect_cache.pop(cid, None)
+    else:
+        refresh_inventory(cid)
+    collect_now.set()
+
+def inventory_containers():
+    with inventory_lock:
+        containers = list(inventory.values())
+    # Same order as the list endpoint: newest first
+    containers.sort(key=lambda c: c.attrs.get("Created", 0), reverse=True)
+    return containers
+
+def watch_events():
+    since = None
+    while True:
+        try:
+            if since is None:
+                # Cursor is taken before listing so anything that happens
+                # while listing is replayed by the stream.
+                since = "%.9f" % time.time()
+                resync_inventory()
+            stream = stream_client.events(
+                decode=True, since=since, filters={"type": "container"}
+            )
+        except Exception as e:
+            print("Events error:", e)
+            # Daemon unreachable: the event buffer may not cover the gap
+            since = None
+            events_connected.clear()
+            time.sleep(INTERVAL)
+            continue
+
+        events_connected.set()
+        try:
+            for event in stream:
+                since = event_cursor(event) or since
+                try:
+                    handle_event(event)
+                except Exception as e:
+                    print("Event handling error:", e)
+        except Exception as e:
+            print("Events stream error:", e)
+        # Stream dropped: reconnect from the cursor so nothing is lost
+        time.sleep(1)
+
+# =============================
+# Streaming Stats
+# =============================
+# In stream mode every running container keeps one stats(stream=True)
+# subscription open. The daemon pushes a frame about once a second and the
+# latest one is kept here, so a collection cycle never waits on stats.
+latest_stats = {}   # container id -> last decoded stats frame
+stats_streams = {}  # container id -> stop Event of its stream thread
+stats_streams_lock = threading.Lock()
+
+def stream_stats(cid, stop):
+    stream = None
+    try:
+        stream = stream_client.api.stats(cid, stream=True, decode=True)
+        for frame in stream:
+            if stop.is_set():
+                break
+            latest_stats[cid] = frame
+    except Exception as e:
+        print("Stats stream error:", cid[:12], e)
+    finally:
+        if stream is not None:
+            stream.close()
+        with stats_streams_lock:
+            if stats_streams.get(cid) is stop:
+                del stats_streams[cid]
+                latest_stats.pop(cid, None)
+
+def sync_stats_streams(containers):
+    running = {c.id for c in containers if c.attrs.get("State") == "running"}
+    with stats_streams_lock:
+        for cid, stop in list(stats_streams.items()):
+            if cid not in running:
+                stop.set()
+                del stats_streams[cid]
+                latest_stats.pop(cid, None)
+        for cid in running - set(stats_streams):
+            stop = threading.Event()
+            stats_streams[cid] = stop
+            threading.Thread(
+                target=stream_stats, args=(cid, stop), daemon=True
+            ).start()
+
+def sample_container(c):
+    # -> (cpu percent, memory used bytes, memory limit bytes, stats payload)
+    # The payload is None when it came from the cgroup reader
+    if STATS_MODE == "cgroup":
+        sample = read_cgroup_sample(c.id)
+        if sample is not None:
+            return sample + (None,)
+    stats = get_stats(c)
+    return (
+        calculate_cpu_percent(stats),
+        stats["memory_stats"]["usage"],
+        stats["memory_stats"]["limit"],
+        stats
+    )
+
+def get_stats(c):
+    if STATS_MODE == "stream":
+        stats = latest_stats.get(c.id)
+        # Until the first frame arrives fall back to a one-off sample
+        if stats and stats.get("precpu_stats", {}).get("system_cpu_usage"):
+            return stats
+    return c.stats(stream=False)
+
+# =============================
+# Cgroup Stats
+# =============================
+# Reading a handful of sysfs files costs microseconds where a docker stats
+# call costs about a second. CPU % is computed against this reader's own
+# previous sample: 100% means one fully used core, same as docker stats.
+CGROUP_V2 = os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers"))
+
+cgroup_dirs = {}  # (container id, subsystem) -> cgroup directory
+cgroup_prev = {}  # container id -> (cpu usage ns, monotonic ns)
+
+def find_cgroup_dir(cid, subsystem):
+    key = (cid, subsystem)
+    if key not in cgroup_dirs:
+        base = CGROUP_ROOT if CGROUP_V2 else os.path.join(CGROUP_ROOT, subsystem)
+        # systemd cgroup driver first, then cgroupfs
+        for rel in ("system.slice/docker-%s.scope" % cid, "docker/%s" % cid):
+            path = os.path.join(base, rel)
+            if os.path.isdir(path):
+                cgroup_dirs[key] = path
+                break
+    return cgroup_dirs.get(key)
+
+def read_cgroup_file(path, name):
+    with open(os.path.join(path, name)) as f:
+        return f.read().strip()
+
+def read_cgroup_sample(cid):
+    try:
+        if CGROUP_V2:
+            path = find_cgroup_dir(cid, "")
+            if path is None:
+                return None
+            cpu_stat = dict(
+                line.split() for line in read_cgroup_file(path, "cpu.stat").splitlines()
+            )
+            usage = int(cpu_stat["usage_usec"]) * 1000
+            mem_used = int(read_cgroup_file(path, "memory.current"))
+            mem_limit = read_cgroup_file(path, "memory.max")
+        else:
+            cpu_path = find_cgroup_dir(cid, "cpuacct")
+            mem_path = find_cgroup_dir(cid, "memory")
+            if cpu_path is None or mem_path is None:
+                return None
+            usage = int(read_cgroup_file(cpu_path, "cpuacct.usage"))
+            mem_used = int(read_cgroup_file(mem_path, "memory.usage_in_bytes"))
+            mem_limit = read_cgroup_file(mem_path, "memory.limit_in_bytes")
+    except (OSError, ValueError, KeyError):
+        for subsystem in ("", "cpuacct", "memory"):
+            cgroup_dirs.pop((cid, subsystem), None)
+        return None
+
+    # Unlimited containers report the host memory, like docker stats does
+    host_mem = psutil.virtual_memory().total
+    mem_limit = host_mem if mem_limit == "max" else min(int(mem_limit), host_mem)
+
+    now = time.monotonic_ns()
+    prev = cgroup_prev.get(cid)
+    cgroup_prev[cid] = (usage, now)
+    cpu = 0.0
+    if prev and now > prev[1] and usage >= prev[0]:
+        cpu = round((usage - prev[0]) / (now - prev[1]) * 100, 2)
+    return cpu, mem_used, mem_limit
+
+# =============================
+# Counter Rates
+# =============================
+# Network and block I/O come as monotonically increasing counters; rates are
+# taken against the previous sample of the same container. A counter that
+# went backwards, or a container that restarted (new StartedAt), started
+# over from zero, so the new value itself is the delta. The first sample
+# of a container has nothing to compare with and reports 0.
+NET_COUNTERS = ("rx_bytes", "tx_bytes", "rx_packets", "tx_packets",
+                "rx_errors", "tx_errors")
+rate_prev = {}  # container id -> (read time, started, counters, rates)
+
+def stats_time(stats):
+    # "2024-05-01T10:00:00.123456789Z"; fractional digits vary
+    read = stats.get("read") or ""
+    try:
+        seconds = calendar.timegm(time.strptime(read[:19], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return time.time()
+    frac = read[19:].rstrip("Z").split("+")[0]
+    if frac.startswith("."):
+        seconds += float("0" + frac[:10])
+    return seconds
+
+def stats_counters(stats):
+    counters = {}
+    for iface, net in (stats.get("networks") or {}).items():
+        for name in NET_COUNTERS:
+            counters[(iface, name)] = net.get(name, 0)
+    blkio = stats.get("blkio_stats") or {}
+    # Summed over devices; "Read" on cgroup v1, "read" on v2. A section the
+    # daemon leaves null (io_serviced_recursive on v2) yields no counters.
+    for section, suffix in (("io_service_bytes_recursive", "bytes"),
+                            ("io_serviced_recursive", "ops")):
+        if blkio.get(section) is None:
+            continue
+        for op in ("read", "write"):
+            counters[("blkio", op + "_" + suffix)] = 0
+        for entry in blkio[section]:
+            op = (entry.get("op") or "").lower()
+            if op in ("read", "write"):
+                key = ("blkio", op + "_" + suffix)
+                counters[key] = counters.get(key, 0) + entry.get("value", 0)
+    return counters
+
+def counter_rates(prev_map, cid, read, counters, started):
+    prev = prev_map.get(cid)
+    if prev and prev[0] == read and prev[1] == started:
+        # Same stats frame as last cycle (stream mode): nothing new to rate
+        return prev[3]
+
+    rates = {}
+    elapsed = read - prev[0] if prev else 0
+    for key, value in counters.items():
+        rate = 0.0
+        if prev and elapsed > 0:
+            last = prev[2].get(key)
+            if last is None or prev[1] != started or value < last:
+                last = 0
+            rate = round((value - last) / elapsed, 2)
+        rates[key] = rate
+    prev_map[cid] = (read, started, counters, rates)
+    return rates
+
+def io_fields(rates):
+    networks = {}
+    for (iface, name), rate in rates.items():
+        if iface != "blkio":
+            networks.setdefault(iface, {})[name + "_per_sec"] = rate
+    total = lambda name: round(sum(n[name] for n in networks.values()), 2)
+    return {
+        "net_rx_bytes_per_sec": total("rx_bytes_per_sec"),
+        "net_tx_bytes_per_sec": total("tx_bytes_per_sec"),
+        "networks": networks,
+        # None when the daemon does not report the source section
+        "blkio_read_bytes_per_sec": rates.get(("blkio", "read_bytes")),
+        "blkio_write_bytes_per_sec": rates.get(("blkio", "write_bytes")),
+        "blkio_read_iops": rates.get(("blkio", "read_ops")),
+        "blkio_write_iops": rates.get(("blkio", "write_ops"))
+    }
+
+# =============================
+# Proc Net Sampler
+# =============================
+# /proc/<pid>/net shows the network namespace of that process, so reading
+# it for a container's init PID (State.Pid, already in the inspect cache)
+# gives interface counters, TCP counters and the socket table without any
+# daemon call. Cheap enough to run every second, which is the resolution
+# needed to see a connection leak building up.
+NET_DEV_COLUMNS = {0: "rx_bytes", 1: "rx_packets", 2: "rx_errors", 3: "rx_dropped",
+                   8: "tx_bytes", 9: "tx_packets", 10: "tx_errors", 11: "tx_dropped"}
+TCP_STATES = {
+    "01": "ESTABLISHED", "02": "SYN_SENT", "03": "SYN_RECV", "04": "FIN_WAIT1",
+    "05": "FIN_WAIT2", "06": "TIME_WAIT", "07": "CLOSE", "08": "CLOSE_WAIT",
+    "09": "LAST_ACK", "0A": "LISTEN", "0B": "CLOSING"
+}
+SNMP_TCP = ("ActiveOpens", "PassiveOpens", "AttemptFails", "EstabResets",
+            "CurrEstab", "InErrs", "OutRsts", "RetransSegs")
+
+net_samples = {}     # short id -> latest sample, swapped whole every tick
+net_history = {}     # short id -> deque of (time, established, time_wait, total)
+net_rate_prev = {}   # short id -> counter_rates state
+net_pids = {}        # short id -> last known init PID
+
+def read_proc_file(pid, name):
+    with open(os.path.join(PROC_ROOT, str(pid), "net", name)) as f:
+        return f.read()
+
+def parse_net_dev(text):
+    counters = {}
+    for line in text.splitlines()[2:]:
+        iface, _, values = line.partition(":")
+        iface = iface.strip()
+        if iface == "lo":
+            continue
+        values = values.split()
+        for i, name in NET_DEV_COLUMNS.items():
+            counters[(iface, name)] = int(values[i])
+    return counters
+
+def parse_snmp_tcp(text):
+    # Header line and value line pairs: "Tcp: RtoAlgorithm ..." / "Tcp: 1 ..."
+    lines = [l.split() for l in text.splitlines() if l.startswith("Tcp:")]
+    if len(lines) < 2:
+        return {}
+    values = dict(zip(lines[0][1:], lines[1][1:]))
+    return {name: int(values[name]) for name in SNMP_TCP if name in values}
+
+def count_tcp_states(pid, counts):
+    for name in ("tcp", "tcp6"):
+        try:
+            text = read_proc_file(pid, name)
+        except FileNotFoundError:
+            continue  # no IPv6 in this namespace
+        for line in text.splitlines()[1:]:
+            state = TCP_STATES.get(line.split(None, 4)[3], "UNKNOWN")
+            counts[state] = counts.get(state, 0) + 1
+
+def sample_proc_net(cid, pid):
+    now = time.time()
+    counters = parse_net_dev(read_proc_file(pid, "dev"))
+    tcp = {}
+    count_tcp_states(pid, tcp)
+    rates = counter_rates(net_rate_prev, cid, now, counters, pid)
+    interfaces = {}
+    for (iface, name), rate in rates.items():
+        interfaces.setdefault(iface, {})[name + "_per_sec"] = rate
+    return {
+        "sampled_at": now,
+        "pid": pid,
+        "interfaces": interfaces,
+        "tcp_connections": tcp,
+        "tcp": parse_snmp_tcp(read_proc_file(pid, "snmp"))
+    }
+
+def net_targets(live):
+    # short id -> init PID of every running container. Events drop
+    # inspect_cache entries until the next cycle re-inspects; meanwhile a
+    # container still published as UP keeps its last known PID.
+    targets = {}
+    for cid, (_, attrs) in list(inspect_cache.items()):
+        state = attrs.get("State") or {}
+        if state.get("Running") and state.get("Pid"):
+            targets[cid[:12]] = state["Pid"]
+        else:
+            net_pids.pop(cid[:12], None)
+    for cid in list(net_pids):
+        if cid not in targets and cid not in live:
+            net_pids.pop(cid, None)
+    net_pids.update(targets)
+    return dict(net_pids)
+
+def net_sampler():
+    global net_samples
+    while True:
+        started = time.monotonic()
+        live = {c["id"] for c in cached_data["containers"] if c.get("state") == "UP"}
+        targets = net_targets(live)
+        samples = {}
+        for cid, pid in targets.items():
+            try:
+                sample = sample_proc_net(cid, pid)
+            except (OSError, ValueError, IndexError):
+                # Container gone or PID not visible from here
+                net_rate_prev.pop(cid, None)
+                continue
+            samples[cid] = sample
+            history = net_history.get(cid)
+            if history is None:
+                history = net_history[cid] = deque(maxlen=NET_HISTORY)
+            tcp = sample["tcp_connections"]
+            history.append((
+                round(sample["sampled_at"], 3), tcp.get("ESTABLISHED", 0),
+                tcp.get("TIME_WAIT", 0), sum(tcp.values())
+            ))
+        net_samples = samples
+        # Pruned against the published snapshot, not inspect_cache, so an
+        # event mid-cycle does not wipe the trend
+        for cid in list(net_history):
+            if cid not in targets and cid not in live:
+                net_history.pop(cid, None)
+                net_rate_prev.pop(cid, None)
+        time.sleep(max(0, NET_INTERVAL - (time.monotonic() - started)))
+
+# =============================
+# Container Processes
+# =============================
+# Host PIDs of a container come from its cgroup.procs (falling back to the
+# init PID and its descendants when the cgroup is not readable). Process
+# handles are kept between requests: cpu_percent() is measured against the
+# previous call on the same handle. When a container has new handles or was
+# last read more than PROC_CPU_MAX_AGE ago, every handle is primed and read
+# again PROC_CPU_INTERVAL later, so CPU% always covers a short, known
+# window (returned as "interval"). All reads for one process happen inside
+# oneshot(), which fetches /proc/<pid>/stat and friends a single time.
+# proc_lock only guards the dicts below (the collector prunes them); the
+# sampling itself, sleep included, runs under the container's own lock.
+PROC_CPU_INTERVAL = 0.5  # detik
+PROC_CPU_MAX_AGE = 2 * INTERVAL
+proc_handles = {}  # container id -> {pid: psutil.Process}
+proc_sampled = {}  # container id -> time of the last cpu_percent() read
+proc_locks = {}    # container id -> Lock serializing samples of it
+proc_lock = threading.Lock()
+
+def container_pids(cid):
+    path = find_cgroup_dir(cid, "" if CGROUP_V2 else "cpuacct")
+    if path is not None:
+        try:
+            return [int(p) for p in read_cgroup_file(path, "cgroup.procs").split()], "cgroup"
+        except (OSError, ValueError):
+            cgroup_dirs.pop((cid, "" if CGROUP_V2 else "cpuacct"), None)
+    cached = inspect_cache.get(cid)
+    pid = cached[1].get("State", {}).get("Pid") if cached else None
+    if not pid:
+        return [], None
+    try:
+        init = psutil.Process(pid)
+        return [pid] + [p.pid for p in init.children(recursive=True)], "children"
+    except psutil.Error:
+        return [], None
+
+def process_info(p):
+    with p.oneshot():
+        try:
+            fds = p.num_fds()
+        except (psutil.AccessDenied, AttributeError):
+            fds = None
+        return {
+            "pid": p.pid,
+            "ppid": p.ppid(),
+            "name": p.name(),
+            "cmdline": " ".join(p.cmdline()),
+            "status": p.status(),
+            "cpu_percent": p.cpu_percent(None),
+            "rss_mb": round(p.memory_info().rss / (1024 ** 2), 2),
+            "num_threads": p.num_threads(),
+            "num_fds": fds
+        }
+
+def container_processes(cid):
+    pids, source = container_pids(cid)
+    result = []
+    with proc_lock:
+        container_lock = proc_locks.setdefault(cid, threading.Lock())
+    with container_lock:
+        with proc_lock:
+            handles = {pid: p for pid, p in proc_handles.get(cid, {}).items() if pid in pids}
+            last = proc_sampled.get(cid)
+        primed = False
+        for pid in pids:
+            p = handles.get(pid)
+            if p is not None and p.is_running():  # is_running() catches PID reuse
+                continue
+            try:
+                handles[pid] = psutil.Process(pid)
+                primed = True
+            except psutil.Error:
+                handles.pop(pid, None)
+        if primed or last is None or time.time() - last > PROC_CPU_MAX_AGE:
+            for pid, p in list(handles.items()):
+                try:
+                    p.cpu_percent(None)
+                except psutil.Error:
+                    handles.pop(pid, None)
+            last = time.time()
+            time.sleep(PROC_CPU_INTERVAL)
+        now = time.time()
+        for pid, p in list(handles.items()):
+            try:
+                result.append(process_info(p))
+            except psutil.Error:
+                handles.pop(pid, None)
+        with proc_lock:
+            proc_handles[cid] = handles
+            proc_sampled[cid] = now
+    result.sort(key=lambda i: i["cpu_percent"], reverse=True)
+    return result, source, round(now - last, 3)
+
+def full_container_id(short_id):
+    for cid in list(inspect_cache):
+        if cid.startswith(short_id):
+            return cid
+    return None
+
+# =============================
+# Collect One Container
+# =============================
+def collect_container(c):
+    try:
+        status = c.attrs.get("State", "unknown")
+        state = inspect_container(c)["State"]
+        restart_count = state.get("RestartCount", 0)
+
+        # ---------- STATUS ----------
+        container_state = "UP" if status == "running" else "DOWN"
+
+        cpu = 0.0
+        mem_used = 0.0
+        mem_limit = 0.0
+        io = {}
+
+        if status == "running":
+            cpu, mem_used, mem_limit, stats = sample_container(c)
+            mem_used = mem_used / (1024 ** 2)
+            mem_limit = mem_limit / (1024 ** 2)
+            if stats is not None:
+                io = io_fields(counter_rates(
+                    rate_prev, c.id, stats_time(stats), stats_counters(stats),
+                    state.get("StartedAt")
+                ))
+            net = net_samples.get(c.id[:12])
+            if net is not None:
+                io["tcp_connections"] = net["tcp_connections"]
+
+        return {
+            "id": c.id[:12],
+            "name": container_name(c.attrs),
+            "image": get_image_tags(c.attrs.get("ImageID")),
+            "docker_status": status,
+            "state": container_state,
+            "cpu_percent": cpu,
+            "memory_usage_mb": round(mem_used, 2),
+            "memory_limit_mb": round(mem_limit, 2),
+            "restart_count": restart_count,
+            "ports": format_ports(c.attrs.get("Ports")),
+            **io
+        }
+
+    except Exception as e:
+        return {
+            "id": c.id[:12],
+            "name": container_name(c.attrs),
+            "state": "ERROR",
+            "error": str(e)
+        }
+
 # =============================
 # Update Data
 # =============================
+# Every stats(stream=False) call blocks ~1s on the daemon, so containers are
+# sampled by a bounded pool instead of one after another. map() keeps the
+# result in the same order as the container list.
+collector_pool = ThreadPoolExecutor(max_workers=COLLECT_WORKERS,
+                                    thread_name_prefix="collector")
+
+def collect_snapshot():
+    result = []
+    labels = {}
+    failed = False
+
+    if docker_client:
+        try:
+            if events_connected.is_set():
+                containers = inventory_containers()
+            else:
+                containers = docker_client.containers.list(
+                    all=True, sparse=True
+                )
+            prune_caches(containers)
+            if STATS_MODE == "stream":
+                sync_stats_streams(containers)
+            result = list(collector_pool.map(
+                collect_container, containers
+            ))
+            # Kept beside the records (not in them) for the search index
+            labels = {c.id[:12]: c.attrs.get("Labels") or {} for c in containers}
+        except Exception as e:
+            print("Collect error:", e)
+            failed = True
+
+    return {
+        "containers": result,
+        "labels": labels,
+        # An empty list because the daemon did not answer is not "no
+        # containers": history, archive and state files must not follow it
+        "failed": failed,
+        "system": {
+            "cpu_usage_percent": psutil.cpu_percent(),
+            "memory_usage_percent": psutil.virtual_memory().percent,
+            "disk_usage_percent": psutil.disk_usage("/").percent
+        },
+        "last_update": time.ctime()
+    }
+
+# =============================
+# State Files
+# =============================
+# snapshot.mmap holds two fixed-size slots, each a header (sequence,
+# containers body length, system body length, crc32) followed by the two
+# pre-serialized response bodies. Writes alternate between slots, so a
+# crash mid-write always leaves the other, complete slot to restore from.
+SLOT_HEADER = struct.Struct("<QIII")
+
+def open_mmap(path, size):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+snapshot_file = None
+if STATE_DIR:
+    try:
+        os.makedirs(os.path.join(STATE_DIR, "history"), exist_ok=True)
+        snapshot_file = open_mmap(
+            os.path.join(STATE_DIR, "snapshot.mmap"),
+            2 * (SLOT_HEADER.size + SNAPSHOT_SLOT_SIZE)
+        )
+    except OSError as e:
+        print("State dir error:", e)
+        STATE_DIR = ""
+
+def history_path(name):
+    if not STATE_DIR:
+        return None
+    return os.path.join(STATE_DIR, "history", name + ".ring")
+
+def read_slot(slot):
+    offset = slot * (SLOT_HEADER.size + SNAPSHOT_SLOT_SIZE)
+    seq, containers_len, system_len, crc = SLOT_HEADER.unpack_from(snapshot_file, offset)
+    start = offset + SLOT_HEADER.size
+    if not seq or containers_len + system_len > SNAPSHOT_SLOT_SIZE:
+        return 0, None
+    body = snapshot_file[start:start + containers_len + system_len]
+    if zlib.crc32(body) != crc:
+        return 0, None
+    return seq, (body[:containers_len], body[containers_len:])
+
+def persist_snapshot(snapshot):
+    if snapshot_file is None:
+        return
+    containers_body = snapshot["responses"]["containers"]["body"]
+    system_body = snapshot["responses"]["system"]["body"]
+    body = containers_body + system_body
+    if len(body) > SNAPSHOT_SLOT_SIZE:
+        print("Snapshot too large to persist:", len(body))
+        return
+    # Overwrite the older slot, header last
+    seq = max(read_slot(0)[0], read_slot(1)[0]) + 1
+    offset = (seq % 2) * (SLOT_HEADER.size + SNAPSHOT_SLOT_SIZE)
+    start = offset + SLOT_HEADER.size
+    snapshot_file[start:start + len(body)] = body
+    SLOT_HEADER.pack_into(
+        snapshot_file, offset, seq, len(containers_body), len(system_body),
+        zlib.crc32(body)
+    )
+
+def load_snapshot():
+    if snapshot_file is None:
+        return None
+    slots = [read_slot(0), read_slot(1)]
+    seq, bodies = max(slots, key=lambda s: s[0])
+    if bodies is None:
+        return None
+    try:
+        containers_data = app.json.loads(bodies[0])
+        system_data = app.json.loads(bodies[1])
+    except ValueError:
+        return None
+    for key in ("last_update", "version", "stale"):
+        system_data.pop(key, None)
+    return {
+        "containers": containers_data["containers"],
+        "system": system_data,
+        "last_update": containers_data["last_update"],
+        "version": containers_data.get("version", 0)
+    }
+
+# =============================
+# History
+# =============================
+# One fixed-size ring per container and one for the host. Each metric is a
+# preallocated float32 column (timestamps are float64), so memory is
+# capacity * (8 + 4 * columns) bytes per ring no matter what is stored.
+# Behind the raw ring sit rollup rings (ROLLUP_TIERS) keeping min/max/avg/
+# last per bucket; they are updated as samples arrive, never at query time.
+CONTAINER_METRICS = ("cpu_percent", "memory_usage_mb", "memory_limit_mb")
+SYSTEM_METRICS = ("cpu_usage_percent", "memory_usage_percent", "disk_usage_percent")
+ROLLUP_STATS = ("min", "max", "avg", "last", "count")
+NAN = float("nan")
+
+RING_MAGIC = b"MIRARNG1"
+RING_HEADER = struct.Struct("<8sIIII")
+RING_HEADER_SIZE = 32
+
+def ring_size(capacity, nfields):
+    return RING_HEADER_SIZE + capacity * (8 + 4 * nfields)
+
+class RingBuffer:
+    # Columns are views over one flat buffer: a header (magic, capacity,
+    # field count, head, count), then float64 timestamps, then one float32
+    # column per field. The buffer is a bytearray, or a slice of a mmap'd
+    # file that is then updated in place and survives restarts.
+    def __init__(self, capacity, fields, buf=None):
+        self.capacity = capacity
+        self.fields = fields
+        if buf is None:
+            buf = memoryview(bytearray(ring_size(capacity, len(fields))))
+        self.buf = buf
+        offset = RING_HEADER_SIZE
+        self.ts = buf[offset:offset + 8 * capacity].cast("d")
+        offset += 8 * capacity
+        self.columns = {}
+        for f in fields:
+            self.columns[f] = buf[offset:offset + 4 * capacity].cast("f")
+            offset += 4 * capacity
+        self.lock = threading.Lock()
+
+        magic, cap, nfields, head, count = RING_HEADER.unpack_from(buf)
+        if magic == RING_MAGIC and cap == capacity and nfields == len(fields) \
+                and head < capacity and count <= capacity:
+            self.head, self.count = head, count
+        else:
+            self.head = 0   # next slot to write
+            self.count = 0
+            self._store_header()
+
+    def _store_header(self):
+        RING_HEADER.pack_into(
+            self.buf, 0, RING_MAGIC, self.capacity, len(self.fields),
+            self.head, self.count
+        )
+
+    def append(self, ts, values):
+        with self.lock:
+            self._write(ts, values)
+
+    def _write(self, ts, values):
+        i = self.head
+        for f in self.fields:
+            value = values.get(f)
+            self.columns[f][i] = NAN if value is None else value
+        self.ts[i] = ts
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._store_header()
+
+    def _slice(self, column, lo, hi):
+        # Logical positions lo..hi (0 = oldest) as a list
+        start = (self.head - self.count + lo) % self.capacity
+        n = hi - lo
+        if start + n <= self.capacity:
+            return column[start:start + n].tolist()
+        return column[start:].tolist() + column[:start + n - self.capacity].tolist()
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.ts[(self.head - self.count) % self.capacity]
+
+    def window(self, start, end, fields=None):
+        # -> (timestamps, {field: values}) for start <= ts <= end
+        with self.lock:
+            ts = self._slice(self.ts, 0, self.count)
+            lo, hi = bisect_left(ts, start), bisect_right(ts, end)
+            return ts[lo:hi], {
+                f: self._slice(self.columns[f], lo, hi) for f in fields or self.fields
+            }
+
+def rollup_fields(metrics):
+    return tuple("%s:%s" % (m, stat) for m in metrics for stat in ROLLUP_STATS)
+
+class Rollup(RingBuffer):
+    def __init__(self, resolution, capacity, metrics, buf=None):
+        super().__init__(capacity, rollup_fields(metrics), buf)
+        self.resolution = resolution
+        self.metrics = metrics
+
+    def add(self, ts, values):
+        bucket = ts - ts % self.resolution
+        with self.lock:
+            i = (self.head - 1) % self.capacity
+            if not self.count or self.ts[i] != bucket:
+                self._write(bucket, {"%s:count" % m: 0 for m in self.metrics})
+                i = (self.head - 1) % self.capacity
+
+            cols = self.columns
+            for m in self.metrics:
+                value = values.get(m)
+                if value is None or value != value:
+                    continue
+                n = cols[m + ":count"][i]
+                if n == 0:
+                    cols[m + ":min"][i] = cols[m + ":max"][i] = value
+                    cols[m + ":avg"][i] = value
+                else:
+                    cols[m + ":min"][i] = min(cols[m + ":min"][i], value)
+                    cols[m + ":max"][i] = max(cols[m + ":max"][i], value)
+                    cols[m + ":avg"][i] += (value - cols[m + ":avg"][i]) / (n + 1)
+                cols[m + ":last"][i] = value
+                cols[m + ":count"][i] = n + 1
+
+class MetricHistory:
+    # All tiers share one buffer, backed by a file when path is given
+    def __init__(self, metrics, path=None):
+        self.metrics = metrics
+        self.path = path
+        sizes = [ring_size(HISTORY_SIZE, len(metrics))] + [
+            ring_size(cap, len(rollup_fields(metrics))) for _, cap in ROLLUP_TIERS
+        ]
+        if path:
+            buf = memoryview(open_mmap(path, sum(sizes)))
+        else:
+            buf = memoryview(bytearray(sum(sizes)))
+
+        offset = sizes[0]
+        self.raw = RingBuffer(HISTORY_SIZE, metrics, buf[:offset])
+        self.rollups = []
+        for (res, cap), size in zip(ROLLUP_TIERS, sizes[1:]):
+            self.rollups.append(
+                Rollup(res, cap, metrics, buf[offset:offset + size])
+            )
+            offset += size
+
+    def add(self, ts, values):
+        self.raw.append(ts, values)
+        for rollup in self.rollups:
+            rollup.add(ts, values)
+
+    def oldest(self):
+        found = [t.oldest() for t in [self.raw] + self.rollups if t.count]
+        return min(found) if found else None
+
+    def pick_tier(self, start, step):
+        # Coarsest tier whose buckets are no wider than step and which still
+        # reaches back to start; failing that, the longest-retention tier.
+        tiers = [self.raw] + self.rollups
+        fits = [t for t in tiers if getattr(t, "resolution", 0) <= step]
+        for tier in reversed(fits):
+            oldest = tier.oldest()
+            if tier.count < tier.capacity or (oldest is not None and oldest <= start):
+                return tier
+        for tier in tiers[len(fits):]:
+            oldest = tier.oldest()
+            if tier.count < tier.capacity or (oldest is not None and oldest <= start):
+                return tier
+        return tiers[-1]
+
+    def query(self, start, end, step):
+        tier = self.pick_tier(start, step)
+        ts, columns = tier.window(start, end)
+        if tier is self.raw:
+            if step <= 0:
+                return tier, ts, {m: {"value": columns[m]} for m in self.metrics}
+            # Raw samples are one-sample buckets
+            columns = {
+                "%s:%s" % (m, stat): (
+                    [0 if v != v else 1 for v in columns[m]] if stat == "count"
+                    else columns[m]
+                )
+                for m in self.metrics for stat in ROLLUP_STATS
+            }
+        ts, columns = merge_buckets(ts, columns, self.metrics, step)
+        return tier, ts, columns
+
+def merge_buckets(ts, columns, metrics, step):
+    # Fold min/max/avg/last/count buckets into step-second buckets
+    out_ts = []
+    out = {m: {stat: [] for stat in ROLLUP_STATS} for m in metrics}
+    for i, t in enumerate(ts):
+        bucket = t - t % step if step > 0 else t
+        new = not out_ts or out_ts[-1] != bucket
+        if new:
+            out_ts.append(bucket)
+        for m in metrics:
+            o = out[m]
+            n = columns[m + ":count"][i]
+            if new:
+                o["count"].append(0)
+                for stat in ("min", "max", "avg", "last"):
+                    o[stat].append(NAN)
+            if not n:
+                continue
+            total = o["count"][-1]
+            if total == 0:
+                o["min"][-1] = columns[m + ":min"][i]
+                o["max"][-1] = columns[m + ":max"][i]
+                o["avg"][-1] = columns[m + ":avg"][i]
+            else:
+                o["min"][-1] = min(o["min"][-1], columns[m + ":min"][i])
+                o["max"][-1] = max(o["max"][-1], columns[m + ":max"][i])
+                o["avg"][-1] += (columns[m + ":avg"][i] - o["avg"][-1]) * n / (total + n)
+            o["last"][-1] = columns[m + ":last"][i]
+            o["count"][-1] = total + n
+    return out_ts, out
+
+container_history = {}  # short container id -> MetricHistory
+system_history = MetricHistory(SYSTEM_METRICS, history_path("system"))
+
+def load_history():
+    if not STATE_DIR:
+        return
+    for filename in os.listdir(os.path.join(STATE_DIR, "history")):
+        name, ext = os.path.splitext(filename)
+        if ext == ".ring" and name != "system":
+            container_history[name] = MetricHistory(
+                CONTAINER_METRICS, history_path(name)
+            )
+
+HISTORY_DROP_AFTER = 3  # cycles
+history_missing = {}    # container id -> consecutive cycles not listed
+
+def drop_history(cid):
+    history = container_history.pop(cid, None)
+    if history is not None and history.path:
+        try:
+            os.remove(history.path)
+        except OSError:
+            pass
+
+def record_history(snapshot):
+    now = time.time()
+    system_history.add(now, snapshot["system"])
+    if snapshot.get("failed"):
+        return
+    archive_snapshot(snapshot, now)
+    live = set()
+    for c in snapshot["containers"]:
+        live.add(c["id"])
+        history = container_history.get(c["id"])
+        if history is None:
+            history = container_history[c["id"]] = MetricHistory(
+                CONTAINER_METRICS, history_path(c["id"])
+            )
+        history.add(now, c)
+        history_missing.pop(c["id"], None)
+
+    # A container that drops out of one listing may just be mid-recreate;
+    # its ring is only deleted once it stayed away for HISTORY_DROP_AFTER
+    for cid in list(container_history):
+        if cid not in live:
+            history_missing[cid] = history_missing.get(cid, 0) + 1
+            if history_missing[cid] >= HISTORY_DROP_AFTER:
+                history_missing.pop(cid, None)
+                drop_history(cid)
+
+def query_history(history, args, container_id=None):
+    try:
+        end = float(args.get("to", time.time()))
+        start = float(args.get("from", end - 3600))
+        step = float(args.get("step", 0))
+    except ValueError:
+        abort(400)
+    # float() takes "nan" and "inf", which would end up as bare NaN in JSON
+    if not all(math.isfinite(v) for v in (start, end, step)) or step < 0:
+        abort(400)
+
+    # Older than anything still held in memory: read the archive instead
+    oldest = history.oldest()
+    if container_id and ARCHIVE_PATH and (oldest is None or start < oldest):
+        source, resolution = "archive", 0
+        ts, columns = query_archive(container_id, start, end, step)
+    else:
+        tier, ts, columns = history.query(start, end, step)
+        source, resolution = "memory", getattr(tier, "resolution", 0)
+    return {
+        "from": start,
+        "to": end,
+        "step": step,
+        "source": source,
+        "resolution": resolution,
+        "timestamps": list(ts),
+        # NaN is not valid JSON
+        "metrics": {
+            m: {
+                stat: [
+                    int(v) if stat == "count" else (round(v, 2) if v == v else None)
+                    for v in values
+                ]
+                for stat, values in stats.items()
+            }
+            for m, stats in columns.items()
+        }
+    }
+
+# =============================
+# Archive (SQLite)
+# =============================
+# Samples are queued by the collector and written by one thread in batches,
+# one transaction per flush, in WAL mode. Rows live in one table per UTC day
+# (samples_YYYYMMDD) so retention is a DROP TABLE. Each table is WITHOUT
+# ROWID with PRIMARY KEY (container_id, ts): the table is itself the
+# covering index /history range scans run on. Days older than
+# ARCHIVE_COMPACT_DAYS are compacted to 1-minute averages.
+archive_queue = queue.Queue(maxsize=100000)
+
+def partition_name(ts):
+    return "samples_" + time.strftime("%Y%m%d", time.gmtime(ts))
+
+def partition_day(name):
+    return calendar.timegm(time.strptime(name[len("samples_"):], "%Y%m%d"))
+
+def archive_connect(readonly=False):
+    if readonly:
+        conn = sqlite3.connect("file:%s?mode=ro" % ARCHIVE_PATH, uri=True)
+    else:
+        conn = sqlite3.connect(ARCHIVE_PATH)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def list_partitions(conn):
+    return sorted(r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'samples_%'"
+    ))
+
+def ensure_partition(conn, name, known):
+    if name in known:
+        return
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS %s (container_id TEXT NOT NULL, ts REAL NOT NULL, "
+        "%s, PRIMARY KEY (container_id, ts)) WITHOUT ROWID"
+        % (name, ", ".join("%s REAL" % m for m in CONTAINER_METRICS))
+    )
+    # Tables from older versions may miss newer metrics
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(%s)" % name)}
+    for m in CONTAINER_METRICS:
+        if m not in columns:
+            conn.execute("ALTER TABLE %s ADD COLUMN %s REAL" % (name, m))
+    known.add(name)
+
+def archive_snapshot(snapshot, ts):
+    if not ARCHIVE_PATH:
+        return
+    rows = [
+        (c["id"], ts) + tuple(c.get(m) for m in CONTAINER_METRICS)
+        for c in snapshot["containers"]
+    ]
+    try:
+        archive_queue.put_nowait(rows)
+    except queue.Full:
+        print("Archive queue full, dropping samples")
+
+def flush_archive(conn, known):
+    batches = []
+    while True:
+        try:
+            batches.append(archive_queue.get_nowait())
+        except queue.Empty:
+            break
+    if not batches:
+        return
+
+    by_partition = {}
+    for rows in batches:
+        for row in rows:
+            by_partition.setdefault(partition_name(row[1]), []).append(row)
+    with conn:
+        for name, rows in by_partition.items():
+            ensure_partition(conn, name, known)
+            conn.executemany(
+                "INSERT OR REPLACE INTO %s (container_id, ts, %s) VALUES (?, ?, %s)"
+                % (name, ", ".join(CONTAINER_METRICS),
+                   ", ".join("?" * len(CONTAINER_METRICS))),
+                rows
+            )
+
+def compact_archive(conn, known):
+    now = time.time()
+    today = partition_name(now)
+    for name in list_partitions(conn):
+        age_days = (now - partition_day(name)) / 86400
+        if age_days > ARCHIVE_RETENTION_DAYS + 1:
+            with conn:
+                conn.execute("DROP TABLE %s" % name)
+            known.discard(name)
+            continue
+        compacted = conn.execute(
+            "SELECT 1 FROM archive_compacted WHERE name = ?", (name,)
+        ).fetchone()
+        if name == today or compacted or age_days <= ARCHIVE_COMPACT_DAYS + 1:
+            continue
+        # Rewrite the day as 1-minute averages
+        metrics = ", ".join(CONTAINER_METRICS)
+        with conn:
+            # sqlite3 only opens a transaction implicitly before DML, so the
+            # RENAME and CREATE would autocommit on their own without this
+            conn.execute("BEGIN")
+            conn.execute("ALTER TABLE %s RENAME TO compact_tmp" % name)
+            known.discard(name)
+            ensure_partition(conn, name, known)
+            conn.execute(
+                "INSERT INTO %s (container_id, ts, %s) SELECT container_id, "
+                "CAST(ts AS INTEGER) - CAST(ts AS INTEGER) %% 60 AS bucket, %s "
+                "FROM compact_tmp GROUP BY container_id, bucket"
+                % (name, metrics, ", ".join("AVG(%s)" % m for m in CONTAINER_METRICS))
+            )
+            conn.execute("DROP TABLE compact_tmp")
+            conn.execute("INSERT INTO archive_compacted (name) VALUES (?)", (name,))
+    conn.execute("PRAGMA incremental_vacuum")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def recover_compaction(conn):
+    # Older versions could commit the RENAME of a compaction whose INSERT
+    # then failed, stranding that day's rows in compact_tmp
+    if not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='compact_tmp'"
+    ).fetchone():
+        return
+    first = conn.execute("SELECT MIN(ts) FROM compact_tmp").fetchone()[0]
+    metrics = ", ".join(CONTAINER_METRICS)
+    with conn:
+        conn.execute("BEGIN")
+        if first is not None:
+            name = partition_name(first)
+            ensure_partition(conn, name, set())
+            conn.execute(
+                "INSERT OR REPLACE INTO %s (container_id, ts, %s) "
+                "SELECT container_id, ts, %s FROM compact_tmp" % (name, metrics, metrics)
+            )
+        conn.execute("DROP TABLE compact_tmp")
+
+def archive_writer():
+    conn = archive_connect()
+    conn.execute("CREATE TABLE IF NOT EXISTS archive_compacted (name TEXT PRIMARY KEY)")
+    known = set()
+    try:
+        recover_compaction(conn)
+    except sqlite3.Error as e:
+        print("Archive error:", e)
+    next_compact = 0
+    while True:
+        time.sleep(ARCHIVE_FLUSH)
+        try:
+            flush_archive(conn, known)
+            if time.time() >= next_compact:
+                compact_archive(conn, known)
+                next_compact = time.time() + 3600
+        except sqlite3.Error as e:
+            print("Archive error:", e)
+
+def query_archive(container_id, start, end, step):
+    # One grouped range scan per day table, folded like the memory tiers.
+    # The join picks each bucket's last row straight off the primary key.
+    ts, columns = [], {}
+    if step >= 1:
+        bucket = "CAST(ts AS INTEGER) - CAST(ts AS INTEGER) %% %d" % step
+    else:
+        bucket = "ts"
+    aggregates = ", ".join(
+        "%s(%s)" % (fn, m) for m in CONTAINER_METRICS
+        for fn in ("MIN", "MAX", "AVG", "COUNT")
+    )
+    last = ", ".join("s.%s" % m for m in CONTAINER_METRICS)
+    sql = (
+        "SELECT g.*, %s FROM (SELECT %s AS bucket, MAX(ts) AS last_ts, %s "
+        "FROM {table} WHERE container_id = ? AND ts BETWEEN ? AND ? "
+        "GROUP BY bucket) g JOIN {table} s "
+        "ON s.container_id = ? AND s.ts = g.last_ts ORDER BY g.bucket"
+    ) % (last, bucket, aggregates)
+
+    try:
+        conn = archive_connect(readonly=True)
+    except sqlite3.Error:
+        return merge_buckets(ts, columns, CONTAINER_METRICS, step)
+    try:
+        for name in list_partitions(conn):
+            day = partition_day(name)
+            if day > end or day + 86400 < start:
+                continue
+            for row in conn.execute(sql.format(table=name),
+                                    (container_id, start, end, container_id)):
+                ts.append(row[0])
+                lasts = row[2 + 4 * len(CONTAINER_METRICS):]
+                for i, m in enumerate(CONTAINER_METRICS):
+                    values = row[2 + 4 * i:6 + 4 * i] + (lasts[i],)
+                    for stat, value in zip(("min", "max", "avg", "count", "last"), values):
+                        columns.setdefault("%s:%s" % (m, stat), []).append(
+                            NAN if value is None else value
+                        )
+    except sqlite3.Error as e:
+        print("Archive query error:", e)
+    finally:
+        conn.close()
+    return merge_buckets(ts, columns, CONTAINER_METRICS, step)
+
+# =============================
+# Window Aggregation
+# =============================
+# Statistics for every container over a trailing window of the history the
+# agent already holds. Each container costs one C-level slice and one sort,
+# and results are cached per snapshot version, so dashboards asking the
+# same question every minute share one computation per cycle.
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+aggregate_cache = {"version": None, "results": {}}
+
+def parse_window(text):
+    text = text.strip().lower()
+    if text and text[-1] in WINDOW_UNITS:
+        window = float(text[:-1]) * WINDOW_UNITS[text[-1]]
+    else:
+        window = float(text)
+    if not math.isfinite(window) or window <= 0:
+        raise ValueError("window must be a positive duration")
+    return window
+
+def window_values(history, metric, start, end):
+    # -> (timestamps, {"avg"/"min"/"max": values}, resolution) from the
+    # finest tier that still reaches back to start; rollup tiers give
+    # per-bucket values, so percentiles there are over bucket averages
+    tier = history.pick_tier(start, 0)
+    if tier is history.raw:
+        ts, columns = tier.window(start, end, (metric,))
+        values = columns[metric]
+        return ts, {"avg": values, "min": values, "max": values}, 0
+    names = {stat: "%s:%s" % (metric, stat) for stat in ("avg", "min", "max")}
+    ts, columns = tier.window(start, end, tuple(names.values()))
+    return ts, {stat: columns[name] for stat, name in names.items()}, tier.resolution
+
+def not_nan(values):
+    return [v for v in values if v == v]  # NaN != NaN
+
+def aggregate(ts, columns, stats):
+    values = sorted(not_nan(columns["avg"]))
+    result = {}
+    for stat in stats:
+        if not values:
+            result[stat] = None
+        elif stat == "min":
+            result[stat] = min(not_nan(columns["min"]))
+        elif stat == "max":
+            result[stat] = max(not_nan(columns["max"]))
+        elif stat == "avg":
+            result[stat] = sum(values) / len(values)
+        elif stat == "count":
+            result[stat] = len(values)
+        elif stat == "rate":
+            # Change per second between the first and last sample
+            avg = columns["avg"]
+            first = next(i for i, v in enumerate(avg) if v == v)
+            last = next(i for i in range(len(avg) - 1, -1, -1) if avg[i] == avg[i])
+            elapsed = ts[last] - ts[first]
+            result[stat] = (avg[last] - avg[first]) / elapsed if elapsed > 0 else 0.0
+        else:
+            # pNN, nearest-rank
+            rank = int(-(-float(stat[1:]) * len(values) // 100))
+            result[stat] = values[min(max(rank, 1), len(values)) - 1]
+        if isinstance(result[stat], float):
+            result[stat] = round(result[stat], 2)
+    return result
+
+def parse_stats(text):
+    stats = tuple(s.strip().lower() for s in text.split(",") if s.strip())
+    for stat in stats:
+        if stat in ("min", "max", "avg", "count", "rate"):
+            continue
+        if not re.fullmatch(r"p\d+(\.\d+)?", stat) or float(stat[1:]) > 100:
+            raise ValueError(stat)
+    return stats
+
+def cached_aggregate(snapshot, metric, window, stats):
+    global aggregate_cache
+    cache = aggregate_cache
+    if cache["version"] != snapshot["version"]:
+        cache = aggregate_cache = {"version": snapshot["version"], "results": {}}
+    key = (metric, window, stats)
+    if key not in cache["results"]:
+        cache["results"][key] = serialize(
+            aggregate_containers(snapshot, metric, window, stats)
+        )
+    return cache["results"][key]
+
+def aggregate_containers(snapshot, metric, window, stats):
+    end = time.time()
+    start = end - window
+    rows = []
+    for c in snapshot["containers"]:
+        history = container_history.get(c["id"])
+        if history is None:
+            continue
+        ts, columns, resolution = window_values(history, metric, start, end)
+        rows.append({
+            "id": c["id"],
+            "name": c["name"],
+            "resolution": resolution,
+            **aggregate(ts, columns, stats)
+        })
+    return {
+        "metric": metric,
+        "window": window,
+        "stats": list(stats),
+        "from": start,
+        "to": end,
+        "version": snapshot["version"],
+        "containers": rows
+    }
+
+# =============================
+# Response Cache
+# =============================
+# The read endpoints only change once per cycle, so their bodies are
+# serialized once at publish time and served as-is. The ETag is a hash of
+# the body; since the body carries last_update and version it changes every
+# cycle, so a 304 is only answered to repeat requests within one cycle.
+def serialize(payload):
+    # Same bytes jsonify() would produce
+    return cache_entry(app.json.response(payload).get_data(), app.json.mimetype)
+
+def cache_entry(body, content_type):
+    entry = {
+        "body": body,
+        "content_type": content_type,
+        "etag": hashlib.sha1(body).hexdigest()
+    }
+    # Compressed once here instead of once per request. mtime=0 keeps the
+    # output deterministic for identical bodies.
+    if len(body) >= GZIP_MIN_SIZE:
+        entry["gzip"] = gzip.compress(body, mtime=0)
+    return entry
+
+def render_responses(snapshot):
+    return {
+        "containers": serialize({
+            "total": len(snapshot["containers"]),
+            "containers": snapshot["containers"],
+            "last_update": snapshot["last_update"],
+            "version": snapshot["version"],
+            "stale": snapshot.get("stale", False)
+        }),
+        "system": serialize({
+            **snapshot["system"],
+            "last_update": snapshot["last_update"],
+            "version": snapshot["version"],
+            "stale": snapshot.get("stale", False)
+        }),
+        "metrics": cache_entry(render_metrics(snapshot), METRICS_CONTENT_TYPE)
+    }
+
+def cached_response(snapshot, name):
+    entry = snapshot["responses"][name]
+    if "gzip" in entry and request.accept_encodings["gzip"]:
+        response = app.response_class(entry["gzip"], content_type=entry["content_type"])
+        response.content_encoding = "gzip"
+        # Each representation needs its own strong ETag
+        response.set_etag(entry["etag"] + "-gzip")
+    else:
+        response = app.response_class(entry["body"], content_type=entry["content_type"])
+        response.set_etag(entry["etag"])
+    response.vary.add("Accept-Encoding")
+    # Fresh until the next cycle is due to publish
+    response.cache_control.max_age = max(
+        0, int(snapshot["published_at"] + INTERVAL - time.time())
+    )
+    return response.make_conditional(request)
+
+# =============================
+# Prometheus Metrics
+# =============================
+# Text exposition for /metrics, rendered once per snapshot alongside the
+# JSON bodies so a scrape is just a cached-bytes response.
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+CONTAINER_STATES = ("UP", "DOWN", "ERROR")
+
+def metric_labels(labels):
+    return ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+
+def render_metrics(snapshot):
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            if value is None:
+                continue
+            if labels:
+                lines.append("%s{%s} %s" % (name, metric_labels(labels), float(value)))
+            else:
+                lines.append("%s %s" % (name, float(value)))
+
+    containers = []
+    for c in snapshot["containers"]:
+        image = c.get("image") or [""]
+        containers.append(({"id": c["id"], "name": c["name"], "image": image[0]}, c))
+
+    family("mira_container_cpu_percent", "gauge",
+           "Container CPU usage, 100 = one core.",
+           [(l, c.get("cpu_percent")) for l, c in containers])
+    family("mira_container_memory_usage_bytes", "gauge",
+           "Container memory usage.",
+           [(l, c["memory_usage_mb"] * 1024 ** 2) for l, c in containers
+            if "memory_usage_mb" in c])
+    family("mira_container_memory_limit_bytes", "gauge",
+           "Container memory limit.",
+           [(l, c["memory_limit_mb"] * 1024 ** 2) for l, c in containers
+            if "memory_limit_mb" in c])
+    family("mira_container_restarts_total", "counter",
+           "Times docker restarted the container.",
+           [(l, c.get("restart_count")) for l, c in containers])
+    family("mira_container_state", "gauge",
+           "Container state (UP, DOWN or ERROR), 1 for the current one.",
+           [({**l, "state": state}, 1 if c.get("state") == state else 0)
+            for l, c in containers for state in CONTAINER_STATES])
+
+    system = snapshot["system"]
+    for key in SYSTEM_METRICS:
+        family("mira_host_" + key, "gauge", "Host " + key.replace("_", " ") + ".",
+               [({}, system.get(key))])
+    family("mira_last_update_timestamp_seconds", "gauge",
+           "When this snapshot was published.",
+           [({}, snapshot["published_at"])])
+
+    return ("\n".join(lines) + "\n").encode()
+
+# =============================
+# Snapshot Deltas + Stream Clients
+# =============================
+stream_clients = set()  # one Queue of published snapshots per SSE client
+stream_clients_lock = threading.Lock()
+
+def diff_containers(old, new):
+    old_by_id = {c["id"]: c for c in old}
+    new_ids = {c["id"] for c in new}
+    return {
+        "changed": [c for c in new if old_by_id.get(c["id"]) != c],
+        "removed": [cid for cid in old_by_id if cid not in new_ids]
+    }
+
+def sse_event(event, version, payload):
+    return ("id: %d\nevent: %s\ndata: %s\n\n" % (
+        version, event, app.json.dumps(payload)
+    )).encode()
+
+def render_events(snapshot):
+    delta = snapshot["delta"]
+    return {
+        "snapshot": sse_event("snapshot", snapshot["version"], {
+            "total": len(snapshot["containers"]),
+            "containers": snapshot["containers"],
+            "system": snapshot["system"],
+            "last_update": snapshot["last_update"]
+        }),
+        "delta": sse_event("delta", snapshot["version"], {
+            "total": len(snapshot["containers"]),
+            **delta,
+            "system": snapshot["system"],
+            "last_update": snapshot["last_update"]
+        })
+    }
+
+def notify_stream_clients(snapshot):
+    with stream_clients_lock:
+        clients = list(stream_clients)
+    for q in clients:
+        try:
+            q.put_nowait(snapshot)
+        except queue.Full:
+            # Client misses this one and gets a full snapshot on the gap
+            pass
+
+# =============================
+# Snapshot Versions
+# =============================
+# Every snapshot records the version in which each container last changed,
+# plus tombstones for containers removed within the last VERSION_HISTORY
+# versions, so ?since_version=N can return just what moved after N.
+def track_versions(snapshot, previous):
+    version = snapshot["version"]
+    versions = dict(previous.get("container_versions", {}))
+    removed = dict(previous.get("removed_versions", {}))
+
+    for c in snapshot["delta"]["changed"]:
+        versions[c["id"]] = version
+        removed.pop(c["id"], None)
+    for cid in snapshot["delta"]["removed"]:
+        versions.pop(cid, None)
+        removed[cid] = version
+
+    oldest = max(previous.get("oldest_version", 0), version - VERSION_HISTORY)
+    snapshot["container_versions"] = versions
+    snapshot["removed_versions"] = {
+        cid: v for cid, v in removed.items() if v > oldest
+    }
+    snapshot["oldest_version"] = oldest
+
+def containers_since(snapshot, since):
+    # A cursor from the future belongs to an earlier run of the agent
+    if since < snapshot["oldest_version"] or since > snapshot["version"]:
+        return {
+            "full": True,
+            "containers": snapshot["containers"],
+            "removed": []
+        }
+    versions = snapshot["container_versions"]
+    return {
+        "full": False,
+        "containers": [
+            c for c in snapshot["containers"] if versions.get(c["id"], 0) > since
+        ],
+        "removed": [
+            cid for cid, v in snapshot["removed_versions"].items() if v > since
+        ]
+    }
+
+# =============================
+# Listing Queries
+# =============================
+# ?fields=, ?sort= and ?limit=&cursor= on /api/v1/containers. A cursor
+# pins the snapshot version and sort order of its first page, so paging
+# stays consistent while newer cycles publish; a snapshot is kept around
+# for SNAPSHOT_KEEP seconds after it was replaced. Sorted orders are cached
+# per (version, sort).
+LISTING_ARGS = ("fields", "sort", "limit", "cursor", "where")
+recent_snapshots = {}  # version -> snapshot
+sorted_cache = {}      # (version, sort) -> sorted container list
+sorted_cache_lock = threading.Lock()
+
+query_cache = {}       # (version, normalized query) -> serialized response
+query_cache_lock = threading.Lock()
+
+def cached_query(snapshot, args):
+    # Clients polling the same view share one filtered, serialized result
+    # per snapshot version
+    try:
+        where = normalize_where(args.get("where", ""))
+    except ValueError as e:
+        abort(400, description="where: %s" % e)
+    key = (
+        snapshot["version"], where, args.get("sort", ""), args.get("fields", ""),
+        args.get("limit", ""), args.get("cursor", "")
+    )
+    entry = query_cache.get(key)
+    if entry is None:
+        entry = serialize(query_containers(snapshot, args))
+        with query_cache_lock:
+            if len(query_cache) >= 256:
+                for old in [k for k in query_cache if k[0] != snapshot["version"]]:
+                    query_cache.pop(old, None)
+                if len(query_cache) >= 256:
+                    query_cache.clear()
+            query_cache[key] = entry
+    return entry
+
+def remember_snapshot(snapshot):
+    recent_snapshots[snapshot["version"]] = snapshot
+    versions = sorted(recent_snapshots)
+    for version, newer in zip(versions, versions[1:]):
+        replaced_at = recent_snapshots[newer]["published_at"]
+        if snapshot["published_at"] - replaced_at > SNAPSHOT_KEEP:
+            recent_snapshots.pop(version, None)
+    with sorted_cache_lock:
+        for key in [k for k in sorted_cache if k[0] not in recent_snapshots]:
+            sorted_cache.pop(key, None)
+
+def encode_cursor(state):
+    return base64.urlsafe_b64encode(app.json.dumps(state).encode()).decode().rstrip("=")
+
+def decode_cursor(text):
+    try:
+        state = app.json.loads(base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)))
+        version, offset = int(state["v"]), int(state["o"])
+        sort, where = state.get("sort", ""), state.get("where", "")
+    except (ValueError, KeyError, TypeError):
+        abort(400)
+    if offset < 0 or not isinstance(sort, str) or not isinstance(where, str):
+        abort(400)
+    return version, offset, sort, where
+
+def sort_containers(snapshot, sort):
+    key = (snapshot["version"], sort)
+    if key in sorted_cache:
+        return sorted_cache[key]
+    result = list(snapshot["containers"])
+    # Stable sorts applied last key first give a multi-key order; missing
+    # values always sort last
+    for field in reversed([f for f in sort.split(",") if f]):
+        desc = field.startswith("-")
+        name = field.lstrip("+-")
+        present = [c for c in result if c.get(name) is not None]
+        missing = [c for c in result if c.get(name) is None]
+        try:
+            present.sort(key=lambda c: c[name], reverse=desc)
+        except TypeError:
+            present.sort(key=lambda c: str(c[name]), reverse=desc)
+        result = present + missing
+    # Sort strings come from clients: bounded like query_cache
+    with sorted_cache_lock:
+        if len(sorted_cache) >= 256:
+            for old in [k for k in sorted_cache if k[0] != snapshot["version"]]:
+                sorted_cache.pop(old, None)
+            if len(sorted_cache) >= 256:
+                sorted_cache.clear()
+        sorted_cache[key] = result
+    return result
+
+def project(containers, fields):
+    if not fields:
+        return containers
+    return [{f: c[f] for f in fields if f in c} for c in containers]
+
+# ?where= filter expressions, e.g.
+#   state=="UP" and cpu_percent>50 and image~"nginx"
+# Operators: == != > >= < <= and ~ (regex search); combine with and/or/not
+# and parentheses. A list field (image) matches if any element does.
+# Each distinct expression is parsed once into a predicate (LRU by text).
+WHERE_TOKEN = re.compile(r"""\s*(?:
+    (?P<num>-?\d+(?:\.\d+)?)
+  | (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<op>==|!=|>=|<=|>|<|~|\(|\))
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+)""", re.VERBOSE)
+WHERE_LITERALS = {"true": True, "false": False, "null": None}
+
+def tokenize_where(text):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = WHERE_TOKEN.match(text, pos)
+        if not m or m.end() == pos:
+            raise ValueError("unexpected input at %d" % pos)
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "num":
+            value = float(value)
+        elif kind == "str":
+            # Only quote and backslash escapes: anything else stays as
+            # written so ~ patterns keep their \d, \. and friends
+            value = re.sub(r"\\([\"'\\])", r"\1", value[1:-1])
+        elif kind == "name" and value in WHERE_LITERALS:
+            kind, value = "lit", WHERE_LITERALS[value]
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+def field_value(c, name):
+    value = c
+    for part in name.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+def compare(op, value, literal):
+    if isinstance(value, list):
+        return any(compare(op, v, literal) for v in value)
+    try:
+        if op == "==":
+            return value == literal
+        if op == "!=":
+            return value != literal
+        if op == "~":
+            return value is not None and literal.search(str(value)) is not None
+        if value is None:
+            return False
+        if op == ">":
+            return value > literal
+        if op == ">=":
+            return value >= literal
+        if op == "<":
+            return value < literal
+        return value <= literal
+    except TypeError:
+        return False
+
+@functools.lru_cache(maxsize=256)
+def compile_where(text):
+    tokens = tokenize_where(text)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def take():
+        token = peek()
+        pos[0] += 1
+        return token
+
+    def parse_or():
+        left = parse_and()
+        while peek() == ("name", "or"):
+            take()
+            right = parse_and()
+            left = (lambda a, b: lambda c: a(c) or b(c))(left, right)
+        return left
+
+    def parse_and():
+        left = parse_not()
+        while peek() == ("name", "and"):
+            take()
+            right = parse_not()
+            left = (lambda a, b: lambda c: a(c) and b(c))(left, right)
+        return left
+
+    def parse_not():
+        if peek() == ("name", "not"):
+            take()
+            inner = parse_not()
+            return lambda c: not inner(c)
+        return parse_term()
+
+    def parse_term():
+        kind, value = take()
+        if (kind, value) == ("op", "("):
+            inner = parse_or()
+            if take() != ("op", ")"):
+                raise ValueError("missing )")
+            return inner
+        if kind != "name":
+            raise ValueError("expected a field name")
+        name = value
+        if peek()[0] != "op" or peek()[1] in ("(", ")"):
+            return lambda c: bool(field_value(c, name))
+        op = take()[1]
+        kind, literal = take()
+        if kind not in ("num", "str", "lit"):
+            raise ValueError("expected a value after %s" % op)
+        if op == "~":
+            try:
+                literal = re.compile(str(literal), re.IGNORECASE)
+            except re.error as e:
+                raise ValueError("bad regex: %s" % e)
+        return lambda c: compare(op, field_value(c, name), literal)
+
+    predicate = parse_or()
+    if pos[0] != len(tokens):
+        raise ValueError("unexpected %r" % (peek()[1],))
+    return predicate
+
+def normalize_where(text):
+    # Same expression, same cache key regardless of spacing. Tokens keep
+    # their kind so the literal true and a field named True stay apart.
+    return " ".join("%s:%r" % token for token in tokenize_where(text))
+
+def query_containers(snapshot, args):
+    cursor = args.get("cursor")
+    if cursor:
+        version, offset, sort, where = decode_cursor(cursor)
+        snapshot = recent_snapshots.get(version)
+        if snapshot is None:
+            abort(410)
+    else:
+        offset, sort, where = 0, args.get("sort", ""), args.get("where", "")
+    try:
+        limit = int(args["limit"]) if "limit" in args else None
+    except ValueError:
+        abort(400)
+    if limit is not None and limit < 1:
+        abort(400)
+    fields = [f for f in args.get("fields", "").split(",") if f]
+
+    rows = sort_containers(snapshot, sort) if sort else snapshot["containers"]
+    if where:
+        try:
+            predicate = compile_where(where)
+        except ValueError as e:
+            abort(400, description="where: %s" % e)
+        rows = [c for c in rows if predicate(c)]
+    end = len(rows) if limit is None else offset + limit
+    next_cursor = None
+    if end < len(rows):
+        next_cursor = encode_cursor({
+            "v": snapshot["version"], "o": end, "sort": sort, "where": where
+        })
+    return {
+        "total": len(rows),
+        "containers": project(rows[offset:end], fields),
+        "next_cursor": next_cursor,
+        "last_update": snapshot["last_update"],
+        "version": snapshot["version"]
+    }
+
+# =============================
+# Push Exporter
+# =============================
+# Published snapshots are handed to one exporter thread, which batches
+# PUSH_BATCH cycles per POST over a pooled keep-alive Session. A batch
+# that cannot be delivered goes to the spool directory; spooled batches
+# are replayed oldest first before anything new is sent.
+#
+# Every delta names the version it applies on (base_version); a receiver
+# whose last version differs has missed cycles and must ignore deltas
+# until the next "snapshot" record. Cycles get lost in two places: a full
+# queue drops the newest snapshot, and the first queued snapshot after it
+# goes out in full; an overflowing spool drops its oldest batch, and the
+# next batch built starts with a full snapshot.
+push_queue = queue.Queue(maxsize=PUSH_BATCH * 4)
+push_state = {"resync": True, "dropped": 0, "seq": 0}
+
+def notify_push_exporter(snapshot):
+    # A snapshot restored from state files was never collected by this run
+    # and is not pushed. A failed cycle is: its delta is empty, and
+    # skipping it would break the base_version chain.
+    if not PUSH_URL or (snapshot.get("stale") and not snapshot.get("failed")):
+        return
+    try:
+        push_queue.put_nowait(snapshot)
+    except queue.Full:
+        # Exporter is stuck; only written here, so it only ever grows
+        push_state["dropped"] = snapshot["version"]
+
+def push_record(snapshot, full):
+    record = {
+        "version": snapshot["version"],
+        "last_update": snapshot["last_update"],
+        "system": snapshot["system"]
+    }
+    if full:
+        record["type"] = "snapshot"
+        record["containers"] = snapshot["containers"]
+    else:
+        record["type"] = "delta"
+        record["base_version"] = snapshot["version"] - 1
+        record.update(snapshot["delta"])
+    return record
+
+def push_session():
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=1))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=1))
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Content-Encoding": "gzip"
+    })
+    if PUSH_API_KEY:
+        session.headers["mira-api-key"] = PUSH_API_KEY
+    return session
+
+def post_batch(session, body):
+    try:
+        response = session.post(PUSH_URL, data=body, timeout=PUSH_TIMEOUT)
+        return response.ok
+    except requests.RequestException as e:
+        print("Push error:", e)
+        return False
+
+def spool_files():
+    try:
+        return sorted(f for f in os.listdir(PUSH_SPOOL_DIR) if f.endswith(".json.gz"))
+    except OSError:
+        return []
+
+def spool_batch(body):
+    push_state["seq"] += 1
+    name = "%020d-%06d.json.gz" % (time.time_ns(), push_state["seq"] % 1000000)
+    try:
+        files = spool_files()
+        while len(files) >= PUSH_SPOOL_MAX:
+            os.remove(os.path.join(PUSH_SPOOL_DIR, files.pop(0)))
+            push_state["resync"] = True
+        with open(os.path.join(PUSH_SPOOL_DIR, name), "wb") as f:
+            f.write(body)
+    except OSError as e:
+        # The batch is lost: the next one has to start from a snapshot
+        print("Spool error:", e)
+        push_state["resync"] = True
+
+def replay_spool(session):
+    # -> True once the spool is empty
+    for name in spool_files():
+        path = os.path.join(PUSH_SPOOL_DIR, name)
+        with open(path, "rb") as f:
+            body = f.read()
+        if not post_batch(session, body):
+            return False
+        os.remove(path)
+    return True
+
+def push_cycle(session, resynced):
+    # One batch; returns the updated resynced mark
+    os.makedirs(PUSH_SPOOL_DIR, exist_ok=True)
+    batch = []
+    deadline = time.time() + PUSH_BATCH * INTERVAL
+    while len(batch) < PUSH_BATCH:
+        try:
+            batch.append(push_queue.get(timeout=max(0.1, deadline - time.time())))
+        except queue.Empty:
+            break
+    if not batch:
+        replay_spool(session)
+        return resynced
+
+    records = []
+    for snapshot in batch:
+        dropped = push_state["dropped"]
+        full = PUSH_MODE == "snapshot" or push_state["resync"]
+        if dropped > resynced and snapshot["version"] > dropped:
+            full = True
+            resynced = dropped
+        push_state["resync"] = False
+        records.append(push_record(snapshot, full))
+    body = gzip.compress(app.json.dumps({
+        "host": HOST_LABEL,
+        "mode": PUSH_MODE,
+        "cycles": records
+    }).encode())
+
+    # Keep order: nothing new goes out while older batches are spooled
+    if not replay_spool(session) or not post_batch(session, body):
+        spool_batch(body)
+    return resynced
+
+def push_exporter():
+    session = push_session()
+    resynced = 0  # last dropped version already covered by a full snapshot
+    while True:
+        try:
+            resynced = push_cycle(session, resynced)
+        except Exception as e:
+            # The batch in hand is lost: start the next one from a snapshot
+            print("Push error:", e)
+            push_state["resync"] = True
+            time.sleep(INTERVAL)
+
+# =============================
+# Container Index + Fresh Samples
+# =============================
+# id and name -> position in the snapshot's container list, built once per
+# publish so single-container lookups are O(1).
+def index_containers(containers):
+    index = {}
+    for i, c in enumerate(containers):
+        index[c["id"]] = i
+        if c.get("name"):
+            index.setdefault(c["name"], i)
+    return index
+
+def find_container(snapshot, key):
+    i = snapshot["index"].get(key)
+    # A full (or longer) id finds its short id; names never fall back
+    if i is None and len(key) > 12 and re.fullmatch(r"[0-9a-f]+", key):
+        i = snapshot["index"].get(key[:12])
+    return snapshot["containers"][i] if i is not None else None
+
+# Search index, also built once per publish:
+#   names  - sorted (lowercase name, position) pairs, prefix match by bisect
+#   images - repository, tag, repo:tag and the repo's last path segment
+#   labels - (key, value) and bare key -> positions
+def search_terms(image):
+    image = image.lower()
+    repo, _, tag = image.rpartition(":")
+    if not repo or "/" in tag:
+        repo, tag = image, ""
+    terms = {image, repo, repo.rsplit("/", 1)[-1]}
+    if tag:
+        terms.add(tag)
+    return terms
+
+def index_search(snapshot):
+    names = []
+    images = {}
+    labels = {}
+    side = snapshot.get("labels") or {}
+    for i, c in enumerate(snapshot["containers"]):
+        if c.get("name"):
+            names.append((c["name"].lower(), i))
+        for image in c.get("image") or []:
+            for term in search_terms(image):
+                images.setdefault(term, set()).add(i)
+        for key, value in side.get(c["id"], {}).items():
+            labels.setdefault((key, value), set()).add(i)
+            labels.setdefault(key, set()).add(i)
+    names.sort()
+    return {"names": names, "images": images, "labels": labels}
+
+def search_containers(snapshot, q, label_args):
+    index = snapshot["search"]
+    matches = None
+    if q:
+        q = q.lower()
+        names = index["names"]
+        matches = set(index["images"].get(q, ()))
+        i = bisect_left(names, (q, -1))
+        while i < len(names) and names[i][0].startswith(q):
+            matches.add(names[i][1])
+            i += 1
+    for arg in label_args:
+        key, sep, value = arg.partition("=")
+        hits = index["labels"].get((key, value) if sep else key, set())
+        matches = set(hits) if matches is None else matches & hits
+    return [snapshot["containers"][i] for i in sorted(matches or ())]
+
+# ?fresh=1 samples one container outside the cycle. Concurrent requests for
+# the same container share one in-flight daemon call (the first caller does
+# the work, the rest wait on its Future) and the result is reused for
+# FRESH_TTL seconds, so a burst of clicks costs one stats call.
+fresh_cache = {}     # short id -> (time, record)
+fresh_inflight = {}  # short id -> Future
+fresh_lock = threading.Lock()
+
+def sample_fresh(cid):
+    found = docker_client.containers.list(all=True, sparse=True, filters={"id": cid})
+    if not found:
+        return None
+    return collect_container(found[0])
+
+def fresh_container(cid):
+    with fresh_lock:
+        cached = fresh_cache.get(cid)
+        if cached and time.time() - cached[0] < FRESH_TTL:
+            return cached[1]
+        future = fresh_inflight.get(cid)
+        owner = future is None
+        if owner:
+            future = fresh_inflight[cid] = Future()
+    if not owner:
+        return future.result()
+
+    try:
+        record = sample_fresh(cid)
+        future.set_result(record)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with fresh_lock:
+            fresh_inflight.pop(cid, None)
+            if future.exception() is None:
+                fresh_cache[cid] = (time.time(), future.result())
+            for key in [k for k, v in fresh_cache.items() if time.time() - v[0] >= FRESH_TTL]:
+                fresh_cache.pop(key, None)
+    return record
+
+def publish(snapshot):
+    global cached_data
+    previous = cached_data
+    if snapshot.get("failed"):
+        # The daemon did not answer: keep serving the last known containers
+        # (flagged stale) instead of publishing them all as removed
+        snapshot["containers"] = previous["containers"]
+        snapshot["labels"] = previous.get("labels", {})
+        snapshot["stale"] = True
+    snapshot["version"] = previous.get("version", 0) + 1
+    snapshot["published_at"] = time.time()
+    snapshot["delta"] = diff_containers(
+        previous["containers"], snapshot["containers"]
+    )
+    track_versions(snapshot, previous)
+    snapshot["index"] = index_containers(snapshot["containers"])
+    snapshot["search"] = index_search(snapshot)
+    snapshot["responses"] = render_responses(snapshot)
+    snapshot["events"] = render_events(snapshot)
+    cached_data = snapshot
+    remember_snapshot(snapshot)
+    notify_stream_clients(snapshot)
+    notify_push_exporter(snapshot)
+    if not snapshot.get("stale") and not snapshot.get("failed"):
+        persist_snapshot(snapshot)
+
+def restore_snapshot():
+    # Serve the state persisted by the previous run until the first cycle
+    # finishes. Versions continue from where that run stopped; cursors
+    # older than it cannot be answered incrementally.
+    restored = load_snapshot()
+    if restored is None:
+        return False
+    version = restored.pop("version")
+    cached_data["version"] = version - 1
+    cached_data["oldest_version"] = version
+    restored["stale"] = True
+    publish(restored)
+    return True
+
 def update_data():
     while True:
-        with lock:
-            result = []
-
-            if docker_client:
-                for c in docker_client.containers.list(all=True):
-                    try:
-                        c.reload()
-                        state = c.attrs["State"]
-                        status = state.get("Status", "unknown")
-                        restart_count = state.get("RestartCount", 0)
-
-                        # ---------- STATUS ----------
-                        container_state = "UP" if status == "running" else "DOWN"
-
-                        cpu = 0.0
-                        mem_used = 0.0
-                        mem_limit = 0.0
-
-                        if status == "running":
-                            stats = c.stats(stream=False)
-                            cpu = calculate_cpu_percent(stats)
-                            mem_used = stats["memory_stats"]["usage"] / (1024 ** 2)
-                            mem_limit = stats["memory_stats"]["limit"] / (1024 ** 2)
-
-                        result.append({
-                            "id": c.id[:12],
-                            "name": c.name,
-                            "image": c.image.tags or [],
-                            "docker_status": status,
-                            "state": container_state,
-                            "cpu_percent": cpu,
-                            "memory_usage_mb": round(mem_used, 2),
-                            "memory_limit_mb": round(mem_limit, 2),
-                            "restart_count": restart_count,
-                            "ports": c.ports
-                        })
-
-                    except Exception as e:
-                        result.append({
-                            "id": c.id[:12],
-                            "name": c.name,
-                            "state": "ERROR",
-                            "error": str(e)
-                        })
-
-            cached_data["containers"] = result
-            cached_data["system"] = {
-                "cpu_usage_percent": psutil.cpu_percent(),
-                "memory_usage_percent": psutil.virtual_memory().percent,
-                "disk_usage_percent": psutil.disk_usage("/").percent
-            }
-            cached_data["last_update"] = time.ctime()
+        try:
+            snapshot = collect_snapshot()
+            record_history(snapshot)
+            publish(snapshot)
+        except Exception as e:
+            print("Update error:", e)
 
-        time.sleep(INTERVAL)
+        collect_now.wait(INTERVAL)
+        collect_now.clear()
+
+# =============================
+# Fleet Aggregator
+# =============================
+# Polls every agent's /api/v1/containers concurrently over one pooled
+# keep-alive Session, using ETags so an agent that has not published a new
+# cycle since the last poll costs a 304. Each merge waits at most
+# FLEET_TIMEOUT for the round; an agent that is still
+# in flight keeps its previous records (flagged stale) and is not polled
+# again until its request finishes, so one slow host never stalls the rest.
+fleet_agents = {}
+for entry in FLEET_AGENTS:
+    label, url = "", entry
+    if "=" in entry.split("://")[0]:
+        label, url = entry.split("=", 1)
+    url = url.rstrip("/")
+    label = label or url.split("://")[-1]
+    fleet_agents[label] = {
+        "label": label,
+        "url": url,
+        "etag": None,
+        "records": [],
+        "last_ok": None,
+        "error": None,
+        "in_flight": False
+    }
+
+fleet_data = None  # published by publish_fleet(), same reference-swap rule
+
+def fleet_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=max(1, len(fleet_agents)), pool_maxsize=2
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if FLEET_API_KEY:
+        session.headers["mira-api-key"] = FLEET_API_KEY
+    return session
+
+def poll_agent(session, agent):
+    try:
+        headers = {"If-None-Match": agent["etag"]} if agent["etag"] else {}
+        response = session.get(
+            agent["url"] + "/api/v1/containers", headers=headers, timeout=FLEET_TIMEOUT
+        )
+        if response.status_code == 200:
+            data = response.json()
+            agent["records"] = [
+                {**c, "host": agent["label"]} for c in data.get("containers", [])
+            ]
+            agent["etag"] = response.headers.get("ETag")
+        elif response.status_code != 304:
+            raise requests.RequestException("HTTP %d" % response.status_code)
+        agent["last_ok"] = time.time()
+        agent["error"] = None
+    except (requests.RequestException, ValueError) as e:
+        agent["error"] = str(e)
+    finally:
+        agent["in_flight"] = False
+
+def publish_fleet():
+    global fleet_data
+    now = time.time()
+    containers = []
+    hosts = {}
+    by_host = {}
+    for label, agent in fleet_agents.items():
+        records = agent["records"]
+        by_host[label] = (len(containers), len(containers) + len(records))
+        containers.extend(records)
+        hosts[label] = {
+            "url": agent["url"],
+            "total": len(records),
+            "last_ok": agent["last_ok"],
+            "error": agent["error"],
+            "stale": agent["last_ok"] is None or now - agent["last_ok"] > 3 * INTERVAL
+        }
+    snapshot = {
+        "containers": containers,
+        "hosts": hosts,
+        "by_host": by_host,
+        "published_at": now,
+        "last_update": time.ctime(now)
+    }
+    snapshot["responses"] = {"containers": serialize({
+        "total": len(containers),
+        "hosts": hosts,
+        "containers": containers,
+        "last_update": snapshot["last_update"]
+    })}
+    fleet_data = snapshot
+
+def fleet_poller():
+    session = fleet_session()
+    pool = ThreadPoolExecutor(max_workers=FLEET_WORKERS, thread_name_prefix="fleet")
+    while True:
+        started = time.time()
+        futures = []
+        for agent in fleet_agents.values():
+            if not agent["in_flight"]:
+                agent["in_flight"] = True
+                futures.append(pool.submit(poll_agent, session, agent))
+        wait(futures, timeout=FLEET_TIMEOUT)
+        publish_fleet()
+        time.sleep(max(0, started + INTERVAL - time.time()))
 
 # =============================
 # Background Thread
 # =============================
+load_history()
+if not restore_snapshot():
+    publish(cached_data)
 threading.Thread(target=update_data, daemon=True).start()
 
+if docker_client and USE_EVENTS:
+    threading.Thread(target=watch_events, daemon=True).start()
+
+if docker_client and NET_INTERVAL > 0:
+    threading.Thread(target=net_sampler, daemon=True).start()
+
+if ARCHIVE_PATH:
+    threading.Thread(target=archive_writer, daemon=True).start()
+
+if PUSH_URL:
+    threading.Thread(target=push_exporter, daemon=True).start()
+
+if fleet_agents:
+    publish_fleet()
+    threading.Thread(target=fleet_poller, daemon=True).start()
+
 # =============================
 # API KEY Middleware
 # =============================
@@ -139,23 +2551,227 @@ def health():
 # =============================
 @app.route("/api/v1/containers")
 def containers():
-    with lock:
-        return jsonify({
-            "total": len(cached_data["containers"]),
-            "containers": cached_data["containers"],
-            "last_update": cached_data["last_update"]
-        })
+    snapshot = cached_data
+    since = request.args.get("since_version")
+    if since is None:
+        if any(arg in request.args for arg in LISTING_ARGS):
+            entry = cached_query(snapshot, request.args)
+            return app.response_class(entry["body"], content_type=entry["content_type"])
+        return cached_response(snapshot, "containers")
+
+    try:
+        since = int(since)
+    except ValueError:
+        abort(400)
+    if any(arg in request.args for arg in ("sort", "limit", "cursor")):
+        abort(400, description="since_version only combines with fields and where")
+    result = containers_since(snapshot, since)
+    total = len(snapshot["containers"])
+    where = request.args.get("where", "")
+    if where:
+        try:
+            predicate = compile_where(where)
+        except ValueError as e:
+            abort(400, description="where: %s" % e)
+        # A changed container that stopped matching leaves the filtered view
+        changed = result["containers"]
+        result["containers"] = [c for c in changed if predicate(c)]
+        if not result["full"]:
+            result["removed"] += [c["id"] for c in changed if not predicate(c)]
+        total = sum(1 for c in snapshot["containers"] if predicate(c))
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    result["containers"] = project(result["containers"], fields)
+    return jsonify({
+        "total": total,
+        **result,
+        "last_update": snapshot["last_update"],
+        "version": snapshot["version"],
+        "since_version": since
+    })
+
+@app.route("/api/v1/containers/aggregate")
+def containers_aggregate():
+    metric = request.args.get("metric", "cpu_percent")
+    if metric not in CONTAINER_METRICS:
+        abort(400)
+    try:
+        window = parse_window(request.args.get("window", "1h"))
+        stats = parse_stats(request.args.get("stats", "avg,p95,max"))
+    except ValueError:
+        abort(400)
+
+    entry = cached_aggregate(cached_data, metric, window, stats)
+    return app.response_class(entry["body"], mimetype=app.json.mimetype)
+
+@app.route("/api/v1/containers/search")
+def containers_search():
+    q = request.args.get("q", "").strip()
+    label_args = request.args.getlist("label")
+    if not q and not label_args:
+        abort(400)
+    snapshot = cached_data
+    result = search_containers(snapshot, q, label_args)
+    fields = [f for f in request.args.get("fields", "").split(",") if f]
+    return jsonify({
+        "total": len(result),
+        "containers": project(result, fields),
+        "last_update": snapshot["last_update"],
+        "version": snapshot["version"]
+    })
+
+@app.route("/api/v1/containers/<container_id>")
+def container_detail(container_id):
+    snapshot = cached_data
+    c = find_container(snapshot, container_id)
+    if c is None:
+        abort(404)
+    fresh = request.args.get("fresh") in ("1", "true")
+    if fresh:
+        if not docker_client:
+            abort(503)
+        try:
+            c = fresh_container(c["id"])
+        except Exception as e:
+            print("Fresh sample error:", e)
+            abort(502)
+        if c is None:
+            abort(404)
+    return jsonify({
+        "container": c,
+        "fresh": fresh,
+        "last_update": snapshot["last_update"],
+        "version": snapshot["version"]
+    })
+
+@app.route("/api/v1/containers/<container_id>/net")
+def container_net(container_id):
+    snapshot = cached_data
+    c = find_container(snapshot, container_id)
+    if c is None:
+        abort(404)
+    sample = net_samples.get(c["id"])
+    if sample is None:
+        abort(404)
+    # copy() runs under the GIL; iterating while the sampler appends would not
+    history = net_history.get(c["id"])
+    history = history.copy() if history is not None else ()
+    return jsonify({
+        "id": c["id"],
+        **sample,
+        "history": [
+            {"time": t, "established": est, "time_wait": tw, "total": total}
+            for t, est, tw, total in history
+        ]
+    })
+
+@app.route("/api/v1/containers/<container_id>/processes")
+def container_processes_api(container_id):
+    c = find_container(cached_data, container_id)
+    if c is None:
+        abort(404)
+    cid = full_container_id(c["id"])
+    if cid is None or c.get("state") != "UP":
+        abort(404)
+    processes, source, interval = container_processes(cid)
+    return jsonify({
+        "id": c["id"],
+        "source": source,
+        "interval": interval,
+        "total": len(processes),
+        "processes": processes,
+        "sampled_at": time.time()
+    })
+
+@app.route("/api/v1/containers/<container_id>/history")
+def container_history_api(container_id):
+    c = find_container(cached_data, container_id)
+    history = container_history.get(c["id"]) if c else None
+    if history is None:
+        abort(404)
+    return jsonify({
+        "id": c["id"],
+        "name": c["name"],
+        **query_history(history, request.args, c["id"])
+    })
 
 # =============================
 # System API
 # =============================
 @app.route("/api/v1/system")
 def system():
-    with lock:
-        return jsonify({
-            **cached_data["system"],
-            "last_update": cached_data["last_update"]
-        })
+    return cached_response(cached_data, "system")
+
+@app.route("/api/v1/system/history")
+def system_history_api():
+    return jsonify(query_history(system_history, request.args))
+
+# =============================
+# Fleet API
+# =============================
+@app.route("/api/v1/fleet/containers")
+def fleet_containers():
+    snapshot = fleet_data
+    if not fleet_agents:
+        abort(404)
+    host = request.args.get("host")
+    if host is None:
+        return cached_response(snapshot, "containers")
+    if host not in snapshot["by_host"]:
+        abort(404)
+    lo, hi = snapshot["by_host"][host]
+    return jsonify({
+        "total": hi - lo,
+        "hosts": {host: snapshot["hosts"][host]},
+        "containers": snapshot["containers"][lo:hi],
+        "last_update": snapshot["last_update"]
+    })
+
+# =============================
+# Prometheus API
+# =============================
+@app.route("/metrics")
+def metrics():
+    return cached_response(cached_data, "metrics")
+
+# =============================
+# Stream API (SSE)
+# =============================
+@app.route("/api/v1/stream")
+def stream():
+    q = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    def generate():
+        # Registered on first iteration, so a response that is closed without
+        # ever being iterated (HEAD, early disconnect) leaves nothing behind.
+        # Before reading cached_data, so no publish falls in between.
+        with stream_clients_lock:
+            stream_clients.add(q)
+        try:
+            snapshot = cached_data
+            yield snapshot["events"]["snapshot"]
+            sent = snapshot["version"]
+            while True:
+                try:
+                    snapshot = q.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                if snapshot["version"] <= sent:
+                    continue
+                # Deltas only chain onto the snapshot the client already has
+                if snapshot["version"] == sent + 1:
+                    yield snapshot["events"]["delta"]
+                else:
+                    yield snapshot["events"]["snapshot"]
+                sent = snapshot["version"]
+        finally:
+            with stream_clients_lock:
+                stream_clients.discard(q)
+
+    response = app.response_class(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 # =============================
 # Run